@@ -8,33 +8,72 @@ from dotenv import load_dotenv
 from google.adk.runners import Runner
 from google.adk.sessions import DatabaseSessionService
 from google.genai.types import Content, Part
-import google.generativeai as genai
+from sqlalchemy import event as sa_event
+from sqlalchemy.pool import QueuePool
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from user_persistence_agent.agent import root_agent
 
 DB_FILE = "agent_session_data.db"
 APP_NAME = "stateful_session_app"
+# PRAGMAs run on each connection the session service's engine opens.
+SQLITE_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA busy_timeout=5000",
+]
 FLAGS = flags.FLAGS
 flags.DEFINE_boolean("debug", False, "Enable debug logging.")
 
 def configure_llm():
-    """Configures the LLM."""
+    """Loads the LLM settings into the environment.
+
+    The ADK agent builds its own Gemini client, which reads the API key from
+    the environment, so there is no client to configure here.
+    """
     logging.getLogger().setLevel(logging.WARNING)
     load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '.env'))
 
-    api_key = os.environ.get("GEMINI_API_KEY")
-    if not api_key:
+    if not os.environ.get("GEMINI_API_KEY"):
         raise ValueError("GEMINI_API_KEY environment variable not set.")
-    genai.configure(api_key=api_key)
+
+def remove_db_files():
+    """Removes the session database and its WAL journal files."""
+    for path in (DB_FILE, f"{DB_FILE}-shm", f"{DB_FILE}-wal"):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
 
 def setup_database_session_service():
     """Sets up a session service that uses a database for storage."""
-    if os.path.exists(DB_FILE):
-        os.remove(DB_FILE)
+    remove_db_files()
 
     db_url = f"sqlite:///{DB_FILE}"
-    return DatabaseSessionService(db_url=db_url)
+    # Extra keyword arguments are forwarded to SQLAlchemy's `create_engine`.
+    # A small explicit pool (one steady connection plus a few overflow ones for
+    # concurrent runs) keeps connections open instead of reopening the file.
+    session_service = DatabaseSessionService(
+        db_url=db_url,
+        poolclass=QueuePool,
+        pool_size=1,
+        max_overflow=4,
+        connect_args={"check_same_thread": False, "timeout": 5},
+    )
+
+    @sa_event.listens_for(session_service.db_engine, "connect")
+    def _configure(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    # The service opens a connection to create its tables before the hook is
+    # attached; drop it so every pooled connection goes through the hook.
+    session_service.db_engine.dispose()
+    return session_service
 
 async def create_session(
     session_service: DatabaseSessionService,
@@ -102,57 +141,62 @@ async def main(argv):
 
     persistent_session_service = setup_database_session_service()
 
-    runner = Runner(
-        agent=root_agent,
-        app_name=APP_NAME,
-        session_service=persistent_session_service,
-    )
-
-    print("\n[Run 1: User shares name in NEW session]")
-    USER_ID, USER_NAME, SESSION_ID_1, RUN_ID_1 = "user_John", "John", "session_789", "Run 1"
-    await create_and_run_session(
-        runner,
-        persistent_session_service,
-        APP_NAME,
-        USER_ID,
-        SESSION_ID_1,
-        f"My name is {USER_NAME}.",
-        RUN_ID_1,
-    )
-
-    print("\n[Run 2: User asks for name in a NEW session]")
-    USER_ID, SESSION_ID_2, RUN_ID_2 = "user_John", "session_101", "Run 2"
-    await create_and_run_session(
-        runner,
-        persistent_session_service,
-        APP_NAME,
-        USER_ID,
-        SESSION_ID_2,
-        "What is my name?",
-        RUN_ID_2,
-    )
+    try:
+        runner = Runner(
+            agent=root_agent,
+            app_name=APP_NAME,
+            session_service=persistent_session_service,
+        )
 
-    print("\n[Run 3: A different user in a NEW session]")
-    NEW_USER_ID, SESSION_ID_3, RUN_ID_3 = "user_Jane", "session_202", "Run 3"
-    await create_and_run_session(
-        runner,
-        persistent_session_service,
-        APP_NAME,
-        NEW_USER_ID,
-        SESSION_ID_3,
-        "Do you know my name?",
-        RUN_ID_3,
-    )
+        print("\n[Run 1: User shares name in NEW session]")
+        USER_ID, USER_NAME, SESSION_ID_1, RUN_ID_1 = "user_John", "John", "session_789", "Run 1"
+        await create_and_run_session(
+            runner,
+            persistent_session_service,
+            APP_NAME,
+            USER_ID,
+            SESSION_ID_1,
+            f"My name is {USER_NAME}.",
+            RUN_ID_1,
+        )
 
-    persistent_session_service.db_engine.dispose()
+        # "user:name" is user-scoped state saved by Run 1, so Run 2 starts after it.
+        # Runs 2 and 3 use separate sessions, so their LLM round-trips can overlap.
+        # Output lines are tagged with the run label, so they may interleave.
+        print("\n[Run 2: User asks for name in a NEW session]")
+        USER_ID, SESSION_ID_2, RUN_ID_2 = "user_John", "session_101", "Run 2"
+        print("\n[Run 3: A different user in a NEW session]")
+        NEW_USER_ID, SESSION_ID_3, RUN_ID_3 = "user_Jane", "session_202", "Run 3"
+        await asyncio.gather(
+            create_and_run_session(
+                runner,
+                persistent_session_service,
+                APP_NAME,
+                USER_ID,
+                SESSION_ID_2,
+                "What is my name?",
+                RUN_ID_2,
+            ),
+            create_and_run_session(
+                runner,
+                persistent_session_service,
+                APP_NAME,
+                NEW_USER_ID,
+                SESSION_ID_3,
+                "Do you know my name?",
+                RUN_ID_3,
+            ),
+        )
+    finally:
+        # Release pooled connections so SQLite folds the WAL back into the file.
+        persistent_session_service.db_engine.dispose()
 
 def main_wrapper(argv):
     """Wrapper for the main function."""
     try:
         asyncio.run(main(argv))
     finally:
-        if os.path.exists(DB_FILE):
-            os.remove(DB_FILE)
+        remove_db_files()
 
 if __name__ == "__main__":
     app.run(main_wrapper)
@@ -1,50 +1,115 @@
+import atexit
 import sqlite3
 import os
-from typing import List
+import threading
+from typing import Iterable, List, Tuple
 
 USER_DB = "user_data.db"
 CHECKPOINT_DB = "lg_user_state.db"
 ALL_DBS = [USER_DB, CHECKPOINT_DB]
 
+# PRAGMAs for both the user DB and the checkpoint DB. The app server reads the
+# user DB while tools write to it, so WAL keeps those reads from blocking, and
+# synchronous=NORMAL is enough durability for demo data that is deleted on exit.
+SQLITE_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA busy_timeout=5000",
+]
+
+def configure_connection(conn: sqlite3.Connection):
+    """Applies the performance PRAGMAs to a freshly opened connection."""
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+
+# Rationale for a shared connection:
+# Opening a connection per call pays for the open()/close() syscalls and throws
+# away SQLite's page cache every time. A single long-lived connection keeps the
+# cache warm across lookups. Tools may run on worker threads, so the connection
+# is opened with `check_same_thread=False` and every use is serialized by `_LOCK`.
+_CONN: sqlite3.Connection | None = None
+_LOCK = threading.Lock()
+
+# In-process cache of user names keyed by user_id, so warm users skip SQLite
+# entirely. This process is the only writer, so updating the cache in
+# `persist_user_name_to_db` keeps it consistent. Misses are cached as None too.
+_NAME_CACHE: dict[str, str | None] = {}
+
+def _get_conn() -> sqlite3.Connection:
+    """Returns the shared user database connection, opening it on first use."""
+    global _CONN
+    if _CONN is None:
+        _CONN = sqlite3.connect(USER_DB, check_same_thread=False, cached_statements=256)
+        configure_connection(_CONN)
+    return _CONN
+
+def _close_conn():
+    """Closes the shared user database connection if it is open."""
+    global _CONN
+    with _LOCK:
+        if _CONN is not None:
+            # Lets SQLite refresh any planner statistics the session has made stale.
+            _CONN.execute("PRAGMA optimize")
+            _CONN.close()
+            _CONN = None
+
+atexit.register(_close_conn)
+
 def create_user_database():
     """Creates the user database and the users table if they don't exist."""
-    conn = sqlite3.connect(USER_DB)
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id TEXT PRIMARY KEY,
-            name TEXT
-        )
-    """)
-    conn.commit()
-    conn.close()
+    with _LOCK:
+        conn = _get_conn()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id TEXT PRIMARY KEY,
+                    name TEXT
+                )
+            """)
 
 def get_user_name(user_id: str) -> str | None:
     """Gets the user's name from the database."""
-    conn = sqlite3.connect(USER_DB)
-    cursor = conn.cursor()
-    cursor.execute("SELECT name FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    if result:
-        return result[0]
-    else:
-        return None
+    with _LOCK:
+        if user_id in _NAME_CACHE:
+            return _NAME_CACHE[user_id]
+        result = _get_conn().execute("SELECT name FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        name = result[0] if result else None
+        _NAME_CACHE[user_id] = name
+    return name
 
 def persist_user_name_to_db(user_id: str, name: str):
     """Saves the user's name to the database."""
-    conn = sqlite3.connect(USER_DB)
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR REPLACE INTO users (user_id, name) VALUES (?, ?)", (user_id, name))
-    conn.commit()
-    conn.close()
+    persist_user_names_to_db([(user_id, name)])
+
+def persist_user_names_to_db(pairs: Iterable[Tuple[str, str]]):
+    """Saves several (user_id, name) pairs to the database in one transaction."""
+    pairs = list(pairs)
+    with _LOCK:
+        conn = _get_conn()
+        with conn:
+            # Only touch the row when the name actually changes, so repeated
+            # writes of the same name don't dirty pages or append WAL frames.
+            conn.executemany("""
+                INSERT INTO users (user_id, name) VALUES (?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET name = excluded.name
+                WHERE name IS NOT excluded.name
+            """, pairs)
+        # Once the upsert commits, every row holds its pair's name, either freshly
+        # written or already equal (`IS NOT` also treats NULL as a value).
+        _NAME_CACHE.update(pairs)
 
 def cleanup_db(db_files: List[str]):
     """Cleans up the database files and their journal files."""
+    # The shared connection and cache must not outlive the files they mirror.
+    _close_conn()
+    _NAME_CACHE.clear()
     for db_file in db_files:
-        if os.path.exists(db_file):
-            os.remove(db_file)
-        if os.path.exists(f"{db_file}-shm"):
-            os.remove(f"{db_file}-shm")
-        if os.path.exists(f"{db_file}-wal"):
-            os.remove(f"{db_file}-wal")
\ No newline at end of file
+        for path in (db_file, f"{db_file}-shm", f"{db_file}-wal", f"{db_file}-journal"):
+            # Removing directly avoids an extra stat and the race between
+            # checking for a file and deleting it.
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
\ No newline at end of file
@@ -1,16 +1,17 @@
+import asyncio
+import functools
 import sqlite3
 import os
 from typing import TypedDict, Annotated, List, Dict, Any
 from absl import app, flags
-from langchain_core.messages import AnyMessage, HumanMessage, SystemMessage, ToolMessage, AIMessage
+from langchain_core.messages import AnyMessage, HumanMessage, SystemMessage, ToolMessage
 from langchain_core.tools import tool
 from langgraph.graph import StateGraph, END
-from langgraph.checkpoint.sqlite import SqliteSaver
-from langchain_google_genai import ChatGoogleGenerativeAI
+from langgraph.graph.message import add_messages
 from langgraph.prebuilt import ToolNode, tools_condition
 from dotenv import load_dotenv
 from pathlib import Path
-from db_utils import create_user_database, get_user_name, cleanup_db, persist_user_name_to_db, CHECKPOINT_DB, ALL_DBS
+from db_utils import create_user_database, get_user_name, cleanup_db, persist_user_name_to_db, configure_connection, CHECKPOINT_DB, ALL_DBS
 
 FLAGS = flags.FLAGS
 flags.DEFINE_boolean("debug", False, "Enable debug logging.")
@@ -21,7 +22,7 @@ load_dotenv(dotenv_path=dotenv_path)
 
 # --- 1. Define the State ---
 class AgentState(TypedDict):
-    messages: Annotated[List[AnyMessage], lambda x, y: x + y if y else x]
+    messages: Annotated[List[AnyMessage], add_messages]
     user_name: str
     user_id: str
 
@@ -42,15 +43,22 @@ tools = [remember_user_name_external]
 tool_executor = ToolNode(tools)
 
 
-# Rationale for global initialization:
+# Rationale for cached initialization:
 # Initializing the LLM and binding tools are expensive operations.
-# By defining `llm` and `agent_runnable` here, we create a single,
+# By caching `agent_runnable` here, we create a single,
 # reusable instance that persists for the application's lifecycle.
 # This avoids the severe performance overhead of re-initializing
 # the model on every invocation of the `call_model` node.
-# llm = ChatGoogleGenerativeAI(model="gemini-2.5-pro")
-llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash")
-agent_runnable = llm.bind_tools(tools)
+# The LLM client import is deferred to the first call as well, so importing
+# this module (e.g. for `AgentState`) does not pay for it.
+@functools.lru_cache(maxsize=None)
+def _get_agent_runnable():
+    """Builds the tool-bound LLM on first use."""
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+    # llm = ChatGoogleGenerativeAI(model="gemini-2.5-pro")
+    llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash")
+    return llm.bind_tools(tools)
 
 
 def get_system_prompt(name):
@@ -77,20 +85,23 @@ def get_system_prompt(name):
         
     return system_prompt
 
+@functools.lru_cache(maxsize=32)
+def _system_message(name: str | None) -> SystemMessage:
+    """Returns the SystemMessage for `name`, reusing it across turns."""
+    return SystemMessage(content=get_system_prompt(name=name))
+
 def call_model(state: AgentState):
     """The agent node, which now reads the manually injected state."""
     messages = state["messages"]
     name = state.get("user_name")
     if FLAGS.debug:
         print(f"DEBUG: call_model received name='{name}'")
-   
-    system_prompt = get_system_prompt(name=name)
 
-    all_messages = [SystemMessage(content=system_prompt)] + messages
+    all_messages = [_system_message(name), *messages]
     if FLAGS.debug:
         print(f"DEBUG LLM Input Messages:\n{all_messages}\n")
     
-    response = agent_runnable.invoke(all_messages)
+    response = _get_agent_runnable().invoke(all_messages)
     if FLAGS.debug:
         print(f"DEBUG LLM Response Messages:\n{response}\n")
     
@@ -115,35 +126,64 @@ def call_model(state: AgentState):
 def update_tool_call_with_user_id(state: AgentState):
     """Adds the user_id to the tool call arguments."""
     last_message = state["messages"][-1]
-    if last_message.tool_calls:
-        tool_call = last_message.tool_calls[0]
+    # The LLM may emit several tool calls in one turn, so every call gets the id.
+    # The tool call dicts are owned by the message already in state, so the
+    # update is made in place; re-emitting the message would only append
+    # a duplicate for the checkpointer to serialize.
+    for tool_call in last_message.tool_calls:
         tool_call['args']['user_id'] = state["user_id"]
-        # Create a new AIMessage with the updated tool call
-        new_message = AIMessage(
-            content=last_message.content,
-            tool_calls=[tool_call],
-            id=last_message.id,
-        )
-        return {"messages": [new_message]}
     return {}
 
+def _last_tool_calls(state: AgentState) -> list:
+    """Returns the tool calls of the AI message that precedes the tool results."""
+    # One ToolMessage is appended per tool call, so skip back over all of them.
+    for message in reversed(state["messages"]):
+        if not isinstance(message, ToolMessage):
+            return message.tool_calls
+    return []
+
 # Rationale for this node:
 # Tools are designed to be stateless and cannot modify the agent's internal state directly.
 # This node ensures that the agent's state is updated only *after* the tool has successfully
 # persisted the information to the external database. It acts as a synchronization point,
 # reflecting the external change in the agent's memory for subsequent turns in the conversation.
 def update_user_name_in_state(state: AgentState):
-    """Updates the user_name in the state based on the last tool call."""
+    """Updates the user_name in the state based on the name tool calls of the last turn."""
     if FLAGS.debug:
         print(f"\n--- DEBUG: State before explicit update: User Name in State: {state.get('user_name')} ---")
     
-    last_message = state["messages"][-2] # The message before the tool result
-    if last_message.tool_calls:
-        tool_call = last_message.tool_calls[0]
-        if tool_call['name'] == 'remember_user_name_external':
-            name = tool_call['args']['name']
-            return {"user_name": name}
-    return {}
+    # Tool results of this turn, keyed by the tool call they answer.
+    results = {}
+    for message in reversed(state["messages"]):
+        if not isinstance(message, ToolMessage):
+            break
+        results[message.tool_call_id] = message
+
+    # Only reflect names the tool actually persisted.
+    saved_calls = [
+        tool_call for tool_call in _last_tool_calls(state)
+        if tool_call['name'] == 'remember_user_name_external'
+        and tool_call['id'] in results
+        and results[tool_call['id']].status != "error"
+    ]
+    if not saved_calls:
+        return {}
+    if len(saved_calls) == 1:
+        return {"user_name": saved_calls[0]['args']['name']}
+    # ToolNode runs a turn's tool calls on parallel threads, so with several saved
+    # names the external database keeps whichever write committed last. Mirror the
+    # stored name rather than guessing from the call order.
+    return {"user_name": get_user_name(state["user_id"])}
+
+# Rationale for this router:
+# `update_user_name_in_state` only has work to do after `remember_user_name_external`
+# runs. Routing every other tool result straight back to the agent skips a node
+# hop and the checkpoint write that comes with it.
+def _needs_state_update(state: AgentState) -> str:
+    """Routes to 'update_state_with_name' only after a name-saving tool call."""
+    if any(tool_call['name'] == 'remember_user_name_external' for tool_call in _last_tool_calls(state)):
+        return "yes"
+    return "no"
 
 # --- 3. Define Graph Nodes ---
 builder = StateGraph(AgentState)
@@ -171,9 +211,38 @@ builder.add_edge("update_tool_call", "tools")
 #     {"tools": "tools", END: END}
 # )
 
-builder.add_edge("tools", "update_state_with_name")
+builder.add_conditional_edges(
+    "tools",
+    _needs_state_update,
+    {"yes": "update_state_with_name", "no": "agent"}
+)
 builder.add_edge("update_state_with_name", "agent")
 
+# Rationale for caching the compiled graph:
+# Like `agent_runnable` above, the checkpointer connection and the
+# compiled graph are built once and reused for every invocation, so neither
+# connecting nor compiling sits on the hot path of a run.
+@functools.lru_cache(maxsize=None)
+def _get_checkpointer():
+    """Opens the checkpoint database once and wraps it in a SqliteSaver."""
+    from langgraph.checkpoint.sqlite import SqliteSaver
+
+    conn = sqlite3.connect(CHECKPOINT_DB, check_same_thread=False)
+    configure_connection(conn)
+    return SqliteSaver(conn)
+
+@functools.lru_cache(maxsize=None)
+def _get_app():
+    """Compiles the graph against the shared checkpointer."""
+    return builder.compile(checkpointer=_get_checkpointer())
+
+def _close_app():
+    """Closes the checkpoint connection and drops the cached graph."""
+    if _get_checkpointer.cache_info().currsize:
+        _get_checkpointer().conn.close()
+    _get_app.cache_clear()
+    _get_checkpointer.cache_clear()
+
 def generate_agent_state(user_id: str, user_message: str) -> dict:
     """
     Generates the agent state for invoking the graph and prints user preferences.
@@ -206,35 +275,46 @@ def print_agent_response(response: dict, run_label: str):
     if FLAGS.debug:
         print(f"DEBUG {prefix} (Full):\n{agent_response}\n")
 
+async def _amain():
+    create_user_database()
+    app = _get_app()
+
+    # SqliteSaver only implements the sync checkpointer API, so `app.ainvoke`
+    # is unavailable; each run is pushed onto a worker thread instead.
+    # `durability="exit"` persists one checkpoint when a run finishes instead of
+    # one SQLite transaction per node on the agent -> tools cycle.
+    print(f"\n[Run 1: User shares name in NEW session]")
+    USER_ID, USER_NAME, SESSION_ID_1 = "user_John", "John", "session_789"
+    config_1 = {"configurable": {"thread_id": SESSION_ID_1}}
+    initial_state_1 = generate_agent_state(USER_ID, f"Hi, my name is {USER_NAME}.")
+    response = await asyncio.to_thread(app.invoke, initial_state_1, config=config_1, durability="exit")
+    print_agent_response(response, "Run 1")
+    print(f"AppServer: (Write 1) External DB is now: {get_user_name(USER_ID)}")
+
+    # Run 2's initial state is loaded from the external DB that Run 1 writes to.
+    # Runs 2 and 3 use separate thread_ids, so their LLM round-trips can overlap.
+    print(f"\n[Run 2: User asks name in ANOTHER NEW session]")
+    USER_ID, SESSION_ID_2 = "user_John", "session_101"
+    config_2 = {"configurable": {"thread_id": SESSION_ID_2}}
+    initial_state_2 = generate_agent_state(USER_ID, "What is my name?")
+
+    print(f"\n[Run 3: A different user in a NEW session]")
+    NEW_USER_ID, SESSION_ID_3 = "user_Jane", "session_202"
+    config_3 = {"configurable": {"thread_id": SESSION_ID_3}}
+    initial_state_3 = generate_agent_state(NEW_USER_ID, "Do you know my name?")
+
+    response_2, response_3 = await asyncio.gather(
+        asyncio.to_thread(app.invoke, initial_state_2, config=config_2, durability="exit"),
+        asyncio.to_thread(app.invoke, initial_state_3, config=config_3, durability="exit"),
+    )
+    print_agent_response(response_2, "Run 2")
+    print_agent_response(response_3, "Run 3")
+
 def main(_):
     try:
-        create_user_database()
-
-        with SqliteSaver.from_conn_string(CHECKPOINT_DB) as memory:
-            app = builder.compile(checkpointer=memory)
-
-            print(f"\n[Run 1: User shares name in NEW session]")
-            USER_ID, USER_NAME, SESSION_ID_1 = "user_John", "John", "session_789"
-            config_1 = {"configurable": {"thread_id": SESSION_ID_1}}
-            initial_state_1 = generate_agent_state(USER_ID, f"Hi, my name is {USER_NAME}.")
-            response = app.invoke(initial_state_1, config=config_1)
-            print_agent_response(response, "Run 1")
-            print(f"AppServer: (Write 1) External DB is now: {get_user_name(USER_ID)}")
-
-            print(f"\n[Run 2: User asks name in ANOTHER NEW session]")
-            USER_ID, SESSION_ID_2 = "user_John", "session_101"
-            config_2 = {"configurable": {"thread_id": SESSION_ID_2}}
-            initial_state_2 = generate_agent_state(USER_ID, "What is my name?")
-            response = app.invoke(initial_state_2, config=config_2)
-            print_agent_response(response, "Run 2")
-
-            print(f"\n[Run 3: A different user in a NEW session]")
-            NEW_USER_ID, SESSION_ID_3 = "user_Jane", "session_202"
-            config_3 = {"configurable": {"thread_id": SESSION_ID_3}}
-            initial_state_3 = generate_agent_state(NEW_USER_ID, "Do you know my name?")
-            response = app.invoke(initial_state_3, config=config_3)
-            print_agent_response(response, "Run 3")
+        asyncio.run(_amain())
     finally:
+        _close_app()
         cleanup_db(ALL_DBS)
 
 if __name__ == "__main__":